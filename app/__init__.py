@@ -1,10 +1,60 @@
 import os
 import logging
-from flask import Flask, redirect, url_for, flash, request
+from flask import Flask, redirect, url_for, flash, request, current_app
+from sqlalchemy import inspect, text, Date
 from config import app_config # Import from root config.py
-from .extensions import db, login_manager
+from .extensions import db, login_manager, OrjsonProvider
 from .models import User # Import User model for context setup
 
+# Date columns that older versions stored as ISO strings (DateAsString)
+DATE_COLUMNS = {
+    'master_task': ['due_date', 'last_reset_date'],
+    'sub_task': ['completion_date'],
+    'daily_summary': ['summary_date'],
+}
+
+# Rows that would violate a unique index added to an existing table, removed right before the index is created
+UNIQUE_INDEX_DEDUP = {
+    # Keep the most recently written summary of each user and day
+    'uq_dailysummary_user_date': [
+        'DELETE FROM daily_summary WHERE id NOT IN (SELECT MAX(id) FROM daily_summary GROUP BY user_id, summary_date)',
+    ],
+    # Merge same-titled templates of a user into the oldest one: move their subtasks over, then drop the rest
+    'uq_tasktemplate_user_title': [
+        'UPDATE subtask_template SET template_id = ('
+        ' SELECT MIN(keep.id) FROM task_template keep JOIN task_template dup'
+        ' ON keep.user_id = dup.user_id AND keep.title = dup.title WHERE dup.id = subtask_template.template_id)'
+        ' WHERE template_id NOT IN (SELECT MIN(id) FROM task_template GROUP BY user_id, title)',
+        'DELETE FROM task_template WHERE id NOT IN (SELECT MIN(id) FROM task_template GROUP BY user_id, title)',
+    ],
+}
+
+def upgrade_existing_schema():
+    """Applies model changes that db.create_all() does not make to existing tables."""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        # Convert legacy string date columns to native DATE (SQLite keeps ISO text, so only Postgres needs this)
+        if db.engine.dialect.name == 'postgresql':
+            for table_name, column_names in DATE_COLUMNS.items():
+                if not inspector.has_table(table_name):
+                    continue
+                column_types = {c['name']: c['type'] for c in inspector.get_columns(table_name)}
+                for column_name in column_names:
+                    if column_name in column_types and not isinstance(column_types[column_name], Date):
+                        conn.execute(text(f'ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE DATE USING {column_name}::date'))
+                        current_app.logger.info(f"Converted {table_name}.{column_name} to DATE.")
+        # create_all() skips tables that already exist, so create indexes added to existing models here
+        for table in db.metadata.sorted_tables:
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)} if inspector.has_table(table.name) else set()
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                for statement in UNIQUE_INDEX_DEDUP.get(index.name, []):
+                    removed = conn.execute(text(statement)).rowcount
+                    if removed:
+                        current_app.logger.warning(f"Merged/removed {removed} duplicate rows before creating {index.name}.")
+                index.create(bind=conn, checkfirst=True)
+
 def create_app(config_object=app_config):
     """Application factory function."""
     app = Flask(__name__, instance_relative_config=False,
@@ -12,6 +62,7 @@ def create_app(config_object=app_config):
                 static_folder='../static') # Explicitly set static folder relative to project root
 
     app.config.from_object(config_object)
+    app.json = OrjsonProvider(app) # Use orjson for jsonify() and the tojson filter
 
     # Initialize extensions
     db.init_app(app)
@@ -43,6 +94,7 @@ def create_app(config_object=app_config):
         # Note: For production, Flask-Migrate is recommended for schema changes
         try:
             db.create_all()
+            upgrade_existing_schema()
             app.logger.info("Database tables checked/created.")
             # Set initial admin flag if specified in environment variables
             admin_username = os.environ.get('ADMIN_USERNAME')
@@ -56,6 +108,13 @@ def create_app(config_object=app_config):
             app.logger.error(f"Error during initial DB setup/admin check: {e}", exc_info=True)
             # Depending on the error, you might want to handle it more gracefully
 
+        # --- CLI Commands ---
+        @app.cli.command('cleanup-old-tasks')
+        def cleanup_old_tasks_command():
+            """Deletes old completed tasks for all users in one pass (schedule daily)."""
+            from .main import cleanup_old_tasks
+            cleanup_old_tasks()
+
         # --- Request Hooks ---
         @app.before_request
         def require_password_change():
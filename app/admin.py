@@ -3,8 +3,7 @@ from flask_login import current_user, login_required
 from functools import wraps
 import secrets
 import openpyxl
-from io import BytesIO
-from sqlalchemy.orm import selectinload
+import tempfile
 
 from .extensions import db # Relative import
 from .models import User, SubTask, MasterTask, get_jst_today # Relative import
@@ -100,6 +99,8 @@ def reset_password(user_id):
     return redirect(url_for('admin.admin_panel'))
 
 
+EXPORT_SPOOL_MAX_SIZE = 8 * 1024 * 1024 # Bytes of an export kept in memory before spilling to disk
+
 @admin_bp.route('/export_user_data/<int:user_id>', methods=['POST'])
 @login_required
 @admin_required
@@ -111,25 +112,22 @@ def export_user_data(user_id):
         return redirect(url_for('admin.admin_panel'))
 
     try:
-        # Fetch all subtasks, eagerly loading the related master task
-        all_subtasks = SubTask.query.join(MasterTask).filter(
+        # Stream only the exported columns in batches, as plain rows (no ORM objects per subtask)
+        subtasks_query = db.session.query(
+            MasterTask.id, MasterTask.title, MasterTask.due_date, MasterTask.is_urgent, MasterTask.is_habit,
+            MasterTask.recurrence_type, MasterTask.recurrence_days,
+            SubTask.id, SubTask.content, SubTask.grid_count, SubTask.is_completed, SubTask.completion_date
+        ).select_from(SubTask).join(SubTask.master_task).filter(
             MasterTask.user_id == user.id
-        ).options(
-            selectinload(SubTask.master_task)
         ).order_by(
             MasterTask.due_date, MasterTask.id, SubTask.id # Logical sorting
-        ).all()
-
-        if not all_subtasks:
-            flash(f"ユーザー「{user.username}」には書き出すタスクデータがありません。", "info")
-            return redirect(url_for('admin.admin_panel'))
+        ).yield_per(500)
 
-        current_app.logger.info(f"Starting data export for user {user.username} (ID: {user_id}). Found {len(all_subtasks)} subtasks.")
+        current_app.logger.info(f"Starting data export for user {user.username} (ID: {user_id}).")
 
-        # Create Excel workbook in memory
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = f"{user.username}_tasks"
+        # Create a write-only Excel workbook (rows are serialized as they are appended)
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(title=f"{user.username}_tasks")
 
         # Define and write header row
         header = [
@@ -140,28 +138,36 @@ def export_user_data(user_id):
         ws.append(header)
 
         # Write data rows
-        for subtask in all_subtasks:
-            master = subtask.master_task
-            completion_date_str = subtask.completion_date.strftime('%Y-%m-%d') if subtask.completion_date else ''
+        subtask_count = 0
+        for (master_id, title, due_date, is_urgent, is_habit, recurrence_type, recurrence_days,
+             subtask_id, content, grid_count, is_completed, completion_date) in subtasks_query:
+            completion_date_str = completion_date.strftime('%Y-%m-%d') if completion_date else ''
             # Calculate delay only for completed non-recurring tasks
             day_diff = ''
-            if subtask.is_completed and subtask.completion_date and master.recurrence_type == 'none':
-                day_diff = (subtask.completion_date - master.due_date).days
+            if is_completed and completion_date and recurrence_type == 'none':
+                day_diff = (completion_date - due_date).days
 
             ws.append([
-                master.id, master.title, master.due_date.strftime('%Y-%m-%d'),
-                'Yes' if master.is_urgent else 'No',
-                'Yes' if master.is_habit else 'No',
-                master.recurrence_type,
-                master.recurrence_days or '', # Handle None for recurrence_days
-                subtask.id, subtask.content, subtask.grid_count,
-                '完了' if subtask.is_completed else '未完了',
+                master_id, title, due_date.strftime('%Y-%m-%d'),
+                'Yes' if is_urgent else 'No',
+                'Yes' if is_habit else 'No',
+                recurrence_type,
+                recurrence_days or '', # Handle None for recurrence_days
+                subtask_id, content, grid_count,
+                '完了' if is_completed else '未完了',
                 completion_date_str,
                 day_diff # Calculated delay
             ])
+            subtask_count += 1
+
+        if not subtask_count:
+            flash(f"ユーザー「{user.username}」には書き出すタスクデータがありません。", "info")
+            return redirect(url_for('admin.admin_panel'))
+
+        current_app.logger.info(f"Wrote {subtask_count} subtasks for user {user.username}.")
 
-        # Save workbook to a BytesIO buffer
-        output = BytesIO()
+        # Save workbook to a spooled buffer: small exports stay in memory, large ones spill to a temp file
+        output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
         wb.save(output)
         output.seek(0) # Rewind the buffer
 
@@ -2,15 +2,25 @@ from flask import (
     Blueprint, render_template, request, redirect, url_for, flash, current_app
 )
 from flask_login import current_user, login_user, logout_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
 import os
 
 from .extensions import db, login_manager # Relative imports
 from .models import User, SubTask, MasterTask, get_jst_today # Import models needed here
 from datetime import timedelta
+from sqlalchemy import func
+from sqlalchemy.orm import load_only
 
 auth_bp = Blueprint('auth', __name__)
 
+@login_manager.user_loader
+def load_user(user_id):
+    """Loads the logged-in user for Flask-Login (called once per request)."""
+    # session.get checks the identity map first, so repeated loads in a request don't hit the DB
+    # Only the columns every request reads; password_hash / spreadsheet_url load on first access (login, settings, export)
+    return db.session.get(User, int(user_id), options=[
+        load_only(User.id, User.username, User.is_admin, User.password_reset_required)
+    ])
+
 # --- Authentication Routes ---
 
 @auth_bp.route('/register', methods=['GET', 'POST'])
@@ -95,6 +105,15 @@ def login():
             return redirect(url_for('auth.login'))
 
         # Login successful
+        # Upgrade legacy (pbkdf2) or outdated hashes while the plaintext password is available
+        if user.password_needs_rehash():
+            try:
+                user.set_password(password)
+                db.session.commit()
+                current_app.logger.info(f"Rehashed password for user {username}.")
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"Error rehashing password for {username}: {e}", exc_info=True)
         login_user(user, remember=remember)
         current_app.logger.info(f"User {username} logged in successfully.")
 
@@ -185,16 +204,14 @@ def settings():
     try:
         cleanup_threshold_days = 32
         # Find the oldest completed non-recurring subtask for the user
-        oldest_completed_subtask = SubTask.query.join(MasterTask).filter(
+        oldest_completion_date = db.session.query(func.min(SubTask.completion_date)).join(MasterTask).filter(
             MasterTask.user_id == current_user.id,
             MasterTask.recurrence_type == 'none',
-            SubTask.is_completed == True,
-            SubTask.completion_date != None
-        ).order_by(SubTask.completion_date.asc()).first()
+            SubTask.is_completed == True
+        ).scalar() # MIN() ignores NULL completion dates
 
-        if oldest_completed_subtask:
+        if oldest_completion_date:
             today = get_jst_today()
-            oldest_completion_date = oldest_completed_subtask.completion_date
             deletion_date = oldest_completion_date + timedelta(days=cleanup_threshold_days)
             days_until_deletion = (deletion_date - today).days # Can be negative if past due
 
@@ -1,7 +1,26 @@
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+import orjson
 
 # Initialize extensions without app object
 db = SQLAlchemy()
 login_manager = LoginManager()
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes with orjson (C implementation) instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        # Map the stdlib-style kwargs used by jsonify / the tojson filter onto orjson options
+        # Pass date/datetime through to Flask's default so jsonify keeps emitting HTTP dates as before
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        # Passed-through dates and types orjson can't handle natively (Decimal, __html__, ...) go to Flask's default
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
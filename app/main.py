@@ -3,162 +3,253 @@ from flask import (
     jsonify, flash, session, send_file, current_app
 )
 from flask_login import current_user, login_required
-from sqlalchemy import or_, func
-from sqlalchemy.orm import selectinload
+from sqlalchemy import or_, and_, func, select, insert, update, delete, exists, case, cast, Integer
+from sqlalchemy.orm import selectinload, joinedload, raiseload, load_only, aliased
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta, date
 import os
+import sys
 import openpyxl
+from openpyxl.utils.datetime import from_excel
 import json
+import orjson
+import re
+from markupsafe import Markup
 import math
-import pytz
 from io import BytesIO
+from itertools import groupby
+from collections import defaultdict
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import time
 import calendar
 import secrets
 import gspread
+from gspread.utils import convert_credentials
 from oauth2client.service_account import ServiceAccountCredentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .extensions import db
 from .models import (
     User, MasterTask, SubTask, DailySummary, TaskTemplate,
-    SubtaskTemplate, get_jst_today, DateAsString, RecurrenceType
+    SubtaskTemplate, get_jst_today, RecurrenceType
 )
 
 main_bp = Blueprint('main', __name__)
 
+# --- Template Filters ---
+
+@main_bp.app_template_filter('subtasks_json')
+def subtasks_json_filter(subtasks):
+    """Serializes subtasks for the focus modal's data attribute, only for headers that are rendered."""
+    subtasks_as_dicts = [{"id": st.id, "content": st.content, "is_completed": st.is_completed, "grid_count": st.grid_count} for st in subtasks]
+    dumped = orjson.dumps(subtasks_as_dicts).decode()
+    # Escape HTML-significant characters (same as Jinja's tojson) so the JSON is safe inside a quoted attribute
+    return Markup(dumped.replace('&', '\\u0026').replace('<', '\\u003c').replace('>', '\\u003e').replace("'", '\\u0027'))
+
 # --- Helper Functions (specific to main blueprint) ---
 
+def lazy_load_guard():
+    """Loader options for hot read paths: in debug mode any lazy load not covered by an
+    eager loader raises, so N+1 regressions fail loudly in development instead of fanning out in production."""
+    return [raiseload('*')] if current_app.debug else []
+
+def visible_on(target_date):
+    """SQL criteria for the subtasks shown on target_date (use on a MasterTask/SubTask join):
+    non-recurring tasks due that day show uncompleted subtasks or those completed that day;
+    recurring tasks started by then and scheduled that weekday show all subtasks."""
+    return or_(
+        and_(
+            MasterTask.recurrence_type == 'none',
+            MasterTask.due_date == target_date,
+            or_(SubTask.is_completed == False, SubTask.completion_date == target_date)
+        ),
+        and_(
+            MasterTask.due_date <= target_date,
+            or_(
+                MasterTask.recurrence_type == 'daily',
+                and_(MasterTask.recurrence_type == 'weekly', MasterTask.recurrence_days.contains(str(target_date.weekday())))
+            )
+        )
+    )
+
+def upsert_task_template(user_id, title):
+    """Returns the ID of the user's template with this title, creating it if needed.
+    A single INSERT ... ON CONFLICT DO UPDATE ... RETURNING (on uq_tasktemplate_user_title) replaces
+    the SELECT-then-INSERT pair and its race window."""
+    dialect_insert = postgresql_insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+    stmt = dialect_insert(TaskTemplate).values(user_id=user_id, title=title)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TaskTemplate.user_id, TaskTemplate.title],
+        set_={'title': stmt.excluded.title} # No-op update so RETURNING also yields an existing row's ID
+    ).returning(TaskTemplate.id)
+    return db.session.execute(stmt).scalar_one()
+
+MAX_SUBTASK_FIELDS = 20 # Subtask slots accepted per form (sub_content_1..20 / grid_count_1..20)
+SUBTASK_FIELD_RE = re.compile(r'(sub_content|grid_count|subtask_id)_(\d+)')
+
+def form_subtask_fields(form):
+    """Returns the valid (content, grid_count, subtask_id) rows from the subtask form fields, in field order.
+    subtask_id is the existing SubTask a row was rendered from (None for rows added in the form).
+    One pass over the submitted keys instead of probing all 20 slots with formatted names."""
+    fields_by_index = defaultdict(dict)
+    for key, value in form.items():
+        match = SUBTASK_FIELD_RE.fullmatch(key)
+        if match:
+            fields_by_index[int(match[2])][match[1]] = value.strip()
+    subtask_fields = []
+    for i in sorted(fields_by_index):
+        if not 1 <= i <= MAX_SUBTASK_FIELDS:
+            continue
+        sub_content = fields_by_index[i].get('sub_content', '')
+        grid_count_str = fields_by_index[i].get('grid_count', '0')
+        subtask_id_str = fields_by_index[i].get('subtask_id', '')
+        if sub_content and grid_count_str.isdigit() and int(grid_count_str) > 0:
+            subtask_fields.append((sub_content, int(grid_count_str), int(subtask_id_str) if subtask_id_str.isdigit() else None))
+    return subtask_fields
+
 def reset_recurring_tasks_if_needed(user_id):
     """Resets the completion status of recurring tasks based on their schedule."""
     today = get_jst_today()
-    # Find recurring tasks that haven't been reset today (or ever)
-    tasks_to_reset = MasterTask.query.filter(
+    today_weekday = str(today.weekday()) # Monday is 0, Sunday is 6
+    # Recurring tasks that haven't been reset today (or ever), have started, and are scheduled for today
+    due_for_reset = and_(
         MasterTask.user_id == user_id,
         MasterTask.recurrence_type != 'none',
-        or_(MasterTask.last_reset_date == None, MasterTask.last_reset_date < today)
-    ).all()
-
-    reset_count = 0
-    for task in tasks_to_reset:
-        should_reset_today = False
-        # Don't reset if the start date (due_date) is in the future
-        if task.due_date > today:
-            continue
-
-        if task.recurrence_type == 'daily':
-            should_reset_today = True
-        elif task.recurrence_type == 'weekly' and task.recurrence_days:
-            today_weekday = str(today.weekday()) # Monday is 0, Sunday is 6
-            if today_weekday in task.recurrence_days:
-                should_reset_today = True
-
-        if should_reset_today:
-            # Update subtasks: set is_completed=False, completion_date=None
-            subtasks_updated = SubTask.query.filter(
-                SubTask.master_id == task.id,
-                SubTask.is_completed == True
-            ).update({
-                SubTask.is_completed: False,
-                SubTask.completion_date: None
-            }, synchronize_session=False) # Important for bulk updates
-
-            if subtasks_updated > 0:
-                reset_count += subtasks_updated
-            # Update the last reset date for the master task
-            task.last_reset_date = today
+        or_(MasterTask.last_reset_date == None, MasterTask.last_reset_date < today),
+        MasterTask.due_date <= today, # Don't reset if the start date (due_date) is in the future
+        or_(
+            MasterTask.recurrence_type == 'daily',
+            and_(MasterTask.recurrence_type == 'weekly', MasterTask.recurrence_days.contains(today_weekday))
+        )
+    )
 
+    # Mark them reset and get their IDs in one statement (usually matches nothing, so the common case is one round trip)
+    reset_master_ids = db.session.execute(
+        update(MasterTask).where(due_for_reset).values(last_reset_date=today)
+        .returning(MasterTask.id).execution_options(synchronize_session=False)
+    ).scalars().all()
+    if not reset_master_ids:
+        return
+
+    # Update subtasks: set is_completed=False, completion_date=None (one bulk UPDATE for all reset tasks)
+    reset_count = db.session.execute(
+        update(SubTask).where(
+            SubTask.master_id.in_(reset_master_ids),
+            SubTask.is_completed == True
+        ).values(is_completed=False, completion_date=None).execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
     if reset_count > 0:
-        db.session.commit()
         current_app.logger.info(f"User {user_id}: Reset {reset_count} subtasks for {today}.")
-    elif tasks_to_reset: # Commit even if no subtasks were reset (to update last_reset_date)
-        db.session.commit()
 
-def update_summary(user_id):
-    """Calculates and updates the daily summary (streak, average grids) for the user."""
-    today = get_jst_today()
-
-    # Calculate average grids completed in the last 30 days
+def calculate_summary(user_id, today):
+    """Calculates the streak and 30-day average grids for the user as of today."""
+    yesterday = today - timedelta(days=1)
     thirty_days_ago = today - timedelta(days=30)
-    grids_last_30_days = db.session.query(
-        func.sum(SubTask.grid_count)
-    ).join(MasterTask).filter(
-        MasterTask.user_id == user_id,
-        SubTask.is_completed == True,
-        SubTask.completion_date >= thirty_days_ago,
-        SubTask.completion_date <= today # Include today
-    ).scalar() or 0 # Default to 0 if no tasks completed
 
-    # Count distinct days with completions in the last 30 days for average calculation
-    distinct_completion_days_count = db.session.query(
-        func.count(func.distinct(SubTask.completion_date))
-    ).join(MasterTask).filter(
-        MasterTask.user_id == user_id,
-        SubTask.is_completed == True,
-        SubTask.completion_date >= thirty_days_ago,
-        SubTask.completion_date <= today
-    ).scalar() or 0
-
-    average_grids = (grids_last_30_days / distinct_completion_days_count) if distinct_completion_days_count > 0 else 0.0
-
-    # Calculate current streak
-    completed_dates = db.session.query(
-        SubTask.completion_date
+    # Grids completed per day, for every day with a completion
+    daily = db.session.query(
+        SubTask.completion_date.label('day'), func.sum(SubTask.grid_count).label('grids')
     ).join(MasterTask).filter(
         MasterTask.user_id == user_id,
         SubTask.is_completed == True,
         SubTask.completion_date != None
-    ).distinct().all()
-
-    streak = 0
-    if completed_dates:
-        unique_dates_set = {d[0] for d in completed_dates}
-        check_date = today
-        # Streak continues if completed today OR yesterday
-        if today in unique_dates_set or (today - timedelta(days=1)) in unique_dates_set:
-            if today not in unique_dates_set: # If not completed today, start checking from yesterday
-                check_date = today - timedelta(days=1)
-            # Go back day by day as long as there was a completion
-            while check_date in unique_dates_set:
-                streak += 1
-                check_date -= timedelta(days=1)
-
-    # Find or create today's summary record
-    summary = DailySummary.query.filter_by(user_id=user_id, summary_date=today).first()
-    if not summary:
-        summary = DailySummary(user_id=user_id, summary_date=today)
-        db.session.add(summary)
-
-    # Update and commit
-    summary.streak = streak
-    summary.average_grids = round(average_grids, 2)
-    db.session.commit()
+    ).group_by(SubTask.completion_date).cte('daily')
 
-# Note: cleanup_old_tasks is not called automatically. Consider scheduling or manual trigger.
-def cleanup_old_tasks(user_id):
-    """Deletes old, completed, non-recurring tasks."""
-    cleanup_threshold = get_jst_today() - timedelta(days=32)
-    old_subtasks_query = SubTask.query.join(MasterTask).filter(
-        MasterTask.user_id == user_id,
-        MasterTask.recurrence_type == 'none',
-        SubTask.is_completed == True,
-        SubTask.completion_date < cleanup_threshold
+    # Gaps and islands: consecutive days share the same (day - row number) value
+    row_number = func.row_number().over(order_by=daily.c.day)
+    if db.session.get_bind().dialect.name == 'sqlite':
+        island = func.julianday(daily.c.day) - row_number # SQLite stores dates as ISO text
+    else:
+        island = daily.c.day - cast(row_number, Integer)
+    islands = select(daily.c.day, island.label('island')).cte('islands')
+
+    # Streak continues if completed today OR yesterday: count the days of that island up to the anchor day
+    anchor_day = select(func.max(daily.c.day)).where(daily.c.day.in_([today, yesterday])).scalar_subquery()
+    anchor_island = select(islands.c.island).where(islands.c.day == anchor_day).scalar_subquery()
+    streak_query = select(func.count()).select_from(islands).where(
+        islands.c.island == anchor_island,
+        islands.c.day <= anchor_day
+    ).scalar_subquery()
+
+    # Average grids per completion day over the last 30 days (including today)
+    average_query = select(func.avg(daily.c.grids)).where(
+        daily.c.day >= thirty_days_ago,
+        daily.c.day <= today
+    ).scalar_subquery()
+
+    # Both values come back from one statement, without shipping every completion date to Python
+    streak, average_grids = db.session.execute(select(streak_query, average_query)).one()
+    return streak or 0, round(float(average_grids or 0.0), 2)
+
+def save_summary(user_id, today, streak, average_grids):
+    """Stores the calculated values in today's summary record (no row write when unchanged) and returns it.
+    A single INSERT ... ON CONFLICT (user_id, summary_date) DO UPDATE, so a background save from a toggle
+    racing a page load's save can't create two records for the same day."""
+    dialect_insert = postgresql_insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+    stmt = dialect_insert(DailySummary).values(
+        user_id=user_id, summary_date=today, streak=streak, average_grids=average_grids
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DailySummary.user_id, DailySummary.summary_date],
+        set_={'streak': stmt.excluded.streak, 'average_grids': stmt.excluded.average_grids},
+        # Unchanged (e.g. toggling mid-day): leave the existing row alone
+        where=or_(DailySummary.streak != stmt.excluded.streak, DailySummary.average_grids != stmt.excluded.average_grids)
     )
-    # Get master_ids before deleting subtasks
-    master_ids_to_check = [st.master_id for st in old_subtasks_query.all()]
+    db.session.execute(stmt)
+    db.session.commit()
+    # The stored values are exactly the ones passed in, so hand back a detached record instead of re-reading it
+    return DailySummary(user_id=user_id, summary_date=today, streak=streak, average_grids=average_grids)
+
+# Summary writes run off the request path on a single worker per process, so rapid toggles don't pile up
+# threads and connections (ordering across processes isn't guaranteed; save_summary's upsert keeps one row per day)
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summary')
 
-    deleted_subtask_count = old_subtasks_query.delete(synchronize_session=False)
+def update_summary(user_id):
+    """Calculates and updates the daily summary (streak, average grids) for the user; returns today's record."""
+    today = get_jst_today()
+    return save_summary(user_id, today, *calculate_summary(user_id, today))
+
+# Note: cleanup_old_tasks is kept off the request path; run `flask --app run cleanup-old-tasks` daily (e.g. from a scheduler).
+def cleanup_old_tasks(user_id=None):
+    """Deletes old, completed, non-recurring tasks (for every user when user_id is None)."""
+    cleanup_threshold = get_jst_today() - timedelta(days=32)
+    # One DELETE scoped to the non-recurring masters via a subquery;
+    # RETURNING yields the affected master IDs without selecting the rows first
+    user_master_ids = select(MasterTask.id).where(MasterTask.recurrence_type == 'none')
+    if user_id is not None:
+        user_master_ids = user_master_ids.where(MasterTask.user_id == user_id)
+    deleted_rows = db.session.execute(
+        delete(SubTask).where(
+            SubTask.master_id.in_(user_master_ids),
+            SubTask.is_completed == True,
+            SubTask.completion_date < cleanup_threshold
+        ).returning(SubTask.master_id).execution_options(synchronize_session=False)
+    ).all()
+    deleted_subtask_count = len(deleted_rows)
+    master_ids_to_check = {master_id for (master_id,) in deleted_rows}
 
     deleted_master_count = 0
     if master_ids_to_check:
         # Find master tasks whose *only* remaining subtasks were the ones deleted
+        # (explicit NOT EXISTS probe, served by the (master_id, is_completed, completion_date) index)
+        remaining_subtasks = exists().where(
+            SubTask.master_id == MasterTask.id,
+            or_(SubTask.is_completed == False, SubTask.completion_date >= cleanup_threshold)
+        )
         masters_to_delete = MasterTask.query.filter(
             MasterTask.id.in_(master_ids_to_check),
-            ~MasterTask.subtasks.any(or_(SubTask.is_completed == False, SubTask.completion_date >= cleanup_threshold))
+            ~remaining_subtasks
         )
         deleted_master_count = masters_to_delete.delete(synchronize_session=False)
 
     if deleted_subtask_count > 0 or deleted_master_count > 0:
         db.session.commit()
-        current_app.logger.info(f"Cleanup: User {user_id} deleted {deleted_master_count} masters, {deleted_subtask_count} subs.")
+        current_app.logger.info(f"Cleanup: User {user_id if user_id is not None else 'all'} deleted {deleted_master_count} masters, {deleted_subtask_count} subs.")
 
 
 # --- Main Routes ---
@@ -197,7 +288,8 @@ def serve_manifest():
 @login_required
 def todo_list(date_str=None):
     """Displays the todo list for a specific date."""
-    reset_recurring_tasks_if_needed(current_user.id) # Reset tasks before displaying
+    user_id = current_user.id # Bind once; current_user resolves through a LocalProxy on every access
+    reset_recurring_tasks_if_needed(user_id) # Reset tasks before displaying
 
     if date_str is None:
         target_date = get_jst_today()
@@ -213,69 +305,54 @@ def todo_list(date_str=None):
     # Calculate the first day of the next month safely
     next_month_first_day = (first_day_of_month + timedelta(days=32)).replace(day=1)
 
+    # Inner join on uncompleted subtasks + DISTINCT master count replaces the correlated EXISTS
+    # (and stops the outer join from counting each master once per subtask)
     uncompleted_tasks_count = db.session.query(
-        MasterTask.due_date, func.count(MasterTask.id)
-    ).outerjoin(SubTask).filter(
-        MasterTask.user_id == current_user.id,
+        MasterTask.due_date, func.count(MasterTask.id.distinct())
+    ).join(SubTask).filter(
+        MasterTask.user_id == user_id,
         MasterTask.due_date >= first_day_of_month,
         MasterTask.due_date < next_month_first_day,
         MasterTask.recurrence_type == 'none', # Only count non-recurring tasks for calendar dots
-        MasterTask.subtasks.any(SubTask.is_completed == False)
+        SubTask.is_completed == False
     ).group_by(MasterTask.due_date).all()
-    # Convert to dictionary for easy JS access { 'YYYY-MM-DD': count }
-    task_counts_for_js = {d.isoformat(): c for d, c in uncompleted_tasks_count}
+    # Serialize straight to JSON for the JS calendar { 'YYYY-MM-DD': count }; orjson renders the date keys as ISO strings
+    task_counts_json = orjson.dumps(dict(uncompleted_tasks_count), option=orjson.OPT_NON_STR_KEYS).decode()
 
     # --- Fetch and filter tasks to display for the target_date ---
-    today_weekday = str(target_date.weekday())
-
-    # Eager load subtasks to avoid N+1 queries in the loop
-    all_master_tasks = MasterTask.query.options(
-        selectinload(MasterTask.subtasks)
-    ).filter(
-        MasterTask.user_id == current_user.id,
-        MasterTask.subtasks.any() # Optimization: Only fetch master tasks with subtasks
-    ).order_by(MasterTask.is_urgent.desc(), MasterTask.due_date.asc(), MasterTask.id.asc()).all()
+    # Latest completion date across *all* of a master's subtasks (for the header), including hidden ones
+    latest_subtask = aliased(SubTask)
+    last_completion_date = select(func.max(latest_subtask.completion_date)).where(
+        latest_subtask.master_id == MasterTask.id
+    ).correlate(MasterTask).scalar_subquery()
+
+    # One JOIN returns only the visible (master, subtask) pairs; visibility is decided in SQL, not in a Python post-filter
+    visible_rows = db.session.query(MasterTask, SubTask, last_completion_date).join(
+        SubTask, SubTask.master_id == MasterTask.id
+    ).options(*lazy_load_guard()).filter(
+        MasterTask.user_id == user_id,
+        visible_on(target_date)
+    ).order_by(
+        MasterTask.is_urgent.desc(), MasterTask.due_date.asc(), MasterTask.id.asc(), SubTask.id.asc()
+    ).all()
 
     daily_tasks_for_template = []       # Tasks due today (non-recurring)
     recurring_tasks_for_template = []   # Recurring tasks active today
-
-    for mt in all_master_tasks:
-        is_visible_today = False
-        # Check if recurring task should be shown today
-        if mt.recurrence_type != 'none' and mt.due_date <= target_date: # Started on or before today
-            if mt.recurrence_type == 'daily':
-                is_visible_today = True
-            elif mt.recurrence_type == 'weekly' and mt.recurrence_days and today_weekday in mt.recurrence_days:
-                is_visible_today = True
-        # Check if non-recurring task is due today
-        elif mt.recurrence_type == 'none' and mt.due_date == target_date:
-            is_visible_today = True
-
-        if not is_visible_today: continue # Skip if not visible today
-
-        # Determine which subtasks to show within the master task card
-        if mt.recurrence_type != 'none':
-            visible_subtasks = mt.subtasks # Show all for recurring
-        else:
-            # Show uncompleted or completed *today* for non-recurring
-            visible_subtasks = [st for st in mt.subtasks if not st.is_completed or st.completion_date == target_date]
-
-        # Only include master task if it has visible subtasks for the day
-        if not visible_subtasks: continue
-
-        # Prepare data for the template
-        mt.visible_subtasks = sorted(visible_subtasks, key=lambda x: x.id) # Sort by ID for consistent order
-        subtasks_as_dicts = [{"id": st.id, "content": st.content, "is_completed": st.is_completed, "grid_count": st.grid_count} for st in mt.visible_subtasks]
-        mt.visible_subtasks_json = json.dumps(subtasks_as_dicts) # For focus modal
-        mt.all_completed_today = all(st.is_completed for st in mt.visible_subtasks) if mt.visible_subtasks else False
-
-        # Calculate last completion date among all subtasks (for header display)
-        all_completed_ever = all(st.is_completed for st in mt.subtasks)
-        if all_completed_ever:
-            completion_dates = [st.completion_date for st in mt.subtasks if st.completion_date]
-            mt.last_completion_date = max(completion_dates) if completion_dates else None
-        else:
-            mt.last_completion_date = None
+    total_grid_count = 0; completed_grid_count = 0 # Grid totals, accumulated per visible master below
+
+    # Rows are ordered by master, so each master's subtasks are contiguous
+    for mt, rows in groupby(visible_rows, key=lambda row: row[0]):
+        rows = list(rows)
+        # Prepare data for the template (subtasks already sorted by ID)
+        mt.visible_subtasks = [st for _, st, _ in rows]
+        mt.all_completed_today = all(st.is_completed for st in mt.visible_subtasks)
+        # Hidden subtasks are always completed ones, so "all visible completed" means "all completed ever"
+        mt.last_completion_date = rows[0][2] if mt.all_completed_today else None
+
+        # Accumulate grid totals from the subtasks already loaded for rendering
+        for st in mt.visible_subtasks:
+            total_grid_count += st.grid_count
+            if st.is_completed: completed_grid_count += st.grid_count
 
         # Add to appropriate list for rendering
         if mt.recurrence_type != 'none':
@@ -284,22 +361,14 @@ def todo_list(date_str=None):
             daily_tasks_for_template.append(mt)
 
     # --- Calculate Grid Data ---
-    all_subtasks_for_day_grid = []
-    # Include visible subtasks from both lists
-    for mt in daily_tasks_for_template: all_subtasks_for_day_grid.extend(mt.visible_subtasks)
-    for mt in recurring_tasks_for_template: all_subtasks_for_day_grid.extend(mt.visible_subtasks)
-
-    total_grid_count = sum(sub.grid_count for sub in all_subtasks_for_day_grid)
-    completed_grid_count = sum(sub.grid_count for sub in all_subtasks_for_day_grid if sub.is_completed)
-
     # Determine grid dimensions
     GRID_COLS, base_rows = 10, 2 # Constants for grid layout
     required_rows = math.ceil(total_grid_count / GRID_COLS) if total_grid_count > 0 else 1
     grid_rows = max(base_rows, required_rows)
 
     # --- Update and Fetch Summary ---
-    update_summary(current_user.id) # Ensure summary is up-to-date
-    latest_summary = DailySummary.query.filter(DailySummary.user_id == current_user.id).order_by(DailySummary.summary_date.desc()).first()
+    # update_summary returns today's record, which is always the latest one; no separate lookup needed
+    latest_summary = update_summary(user_id)
 
     return render_template(
         'index.html',
@@ -312,7 +381,7 @@ def todo_list(date_str=None):
         GRID_COLS=GRID_COLS,
         grid_rows=grid_rows,
         summary=latest_summary,
-        task_counts=task_counts_for_js # Pass counts for the calendar JS
+        task_counts_json=task_counts_json # Pre-serialized counts for the calendar JS
     )
 
 
@@ -322,9 +391,13 @@ def todo_list(date_str=None):
 @main_bp.route('/add_or_edit_task/<int:master_id>', methods=['GET', 'POST'])
 @login_required
 def add_or_edit_task(master_id=None):
-    master_task = db.session.get(MasterTask, master_id) if master_id else None
+    user_id = current_user.id
+    # Subtasks are needed to prefill the edit form
+    master_task = db.session.get(
+        MasterTask, master_id, options=[selectinload(MasterTask.subtasks), *lazy_load_guard()]
+    ) if master_id else None
     # Authorization check
-    if master_task and master_task.user_id != current_user.id:
+    if master_task and master_task.user_id != user_id:
         flash("アクセス権限がありません。", "danger")
         return redirect(url_for('main.todo_list'))
 
@@ -344,35 +417,25 @@ def add_or_edit_task(master_id=None):
                     flash("テンプレート名を指定してください。", "warning")
                     return redirect(request.args.get('back_url') or from_url) # Redirect back
 
-                # Check if template exists, update or create
-                existing_template = TaskTemplate.query.filter_by(user_id=current_user.id, title=template_title).first()
-                if existing_template:
-                    template = existing_template
-                    # Delete existing subtask templates before adding new ones
-                    SubtaskTemplate.query.filter_by(template_id=template.id).delete()
-                    current_app.logger.info(f"Updating template '{template_title}' by user {current_user.id}.")
-                else:
-                    template = TaskTemplate(title=template_title, user_id=current_user.id)
-                    db.session.add(template)
-                    db.session.flush() # Get template.id before adding subtasks
-                    current_app.logger.info(f"Creating new template '{template_title}' by user {current_user.id}.")
-
-                # Add subtask templates from form data
-                subtask_count = 0
-                for i in range(1, 21): # Assuming max 20 subtask fields in form
-                    sub_content = request.form.get(f'sub_content_{i}', '').strip()
-                    grid_count_str = request.form.get(f'grid_count_{i}', '0').strip()
-                    if sub_content and grid_count_str.isdigit() and int(grid_count_str) > 0:
-                        grid_count = int(grid_count_str)
-                        db.session.add(SubtaskTemplate(template_id=template.id, content=sub_content, grid_count=grid_count))
-                        subtask_count += 1
-
-                if subtask_count == 0:
+                # Collect subtask templates from form data and insert them in one batch
+                new_subtask_templates = [
+                    {'content': sub_content, 'grid_count': grid_count}
+                    for sub_content, grid_count, _ in form_subtask_fields(request.form)
+                ]
+
+                if not new_subtask_templates:
                     flash("有効なサブタスクがないため、テンプレートは保存されませんでした。", "warning")
-                    db.session.rollback() # Roll back template creation if no subtasks
                     # No need to pop session data anymore
                     return redirect(request.args.get('back_url') or from_url)
 
+                # Create the template or reuse the existing one with this title, then replace its subtask templates
+                template_id = upsert_task_template(user_id, template_title)
+                db.session.execute(delete(SubtaskTemplate).where(SubtaskTemplate.template_id == template_id))
+                # One multi-row Core INSERT (executemany) instead of per-object unit-of-work inserts
+                db.session.execute(insert(SubtaskTemplate), [
+                    dict(subtask, template_id=template_id) for subtask in new_subtask_templates
+                ])
+                current_app.logger.info(f"Saved template '{template_title}' (ID: {template_id}) by user {user_id}.")
                 db.session.commit()
                 flash(f"テンプレート「{template_title}」を保存しました。", "success")
                 # Redirect back using the 'back_url' parameter passed in the action URL
@@ -396,7 +459,9 @@ def add_or_edit_task(master_id=None):
                 flash("日付の形式が正しくありません (YYYY-MM-DD)。", "warning")
                 return redirect(from_url)
 
+            existing_subtasks = {} # Subtasks of the edited task by ID, matched against the form rows' subtask_id
             if master_task: # --- Update Existing Task ---
+                existing_subtasks = {st.id: st for st in master_task.subtasks}
                 master_task.title = master_title
                 master_task.due_date = due_date_obj # Update start/due date
                 master_task.is_urgent = is_urgent
@@ -406,14 +471,12 @@ def add_or_edit_task(master_id=None):
                 # Reset last_reset_date if recurrence is modified
                 if recurrence_type != 'none': master_task.last_reset_date = None
 
-                current_app.logger.info(f"Updating task ID {master_task.id} for user {current_user.id}.")
-                # Delete existing subtasks before adding new ones
-                SubTask.query.filter_by(master_id=master_task.id).delete()
+                current_app.logger.info(f"Updating task ID {master_task.id} for user {user_id}.")
             else: # --- Create New Task ---
                 master_task = MasterTask(
                     title=master_title,
                     due_date=due_date_obj,
-                    user_id=current_user.id,
+                    user_id=user_id,
                     is_urgent=is_urgent,
                     is_habit=is_habit,
                     recurrence_type=recurrence_type,
@@ -422,24 +485,43 @@ def add_or_edit_task(master_id=None):
                 )
                 db.session.add(master_task)
                 db.session.flush() # Need master_task.id for subtasks
-                current_app.logger.info(f"Creating new task '{master_title}' for user {current_user.id}.")
+                current_app.logger.info(f"Creating new task '{master_title}' for user {user_id}.")
 
             # --- Add/Update Subtasks ---
-            subtask_added = False
-            for i in range(1, 21): # Assuming max 20 subtask fields
-                sub_content = request.form.get(f'sub_content_{i}', '').strip()
-                grid_count_str = request.form.get(f'grid_count_{i}', '0').strip()
-                if sub_content and grid_count_str.isdigit():
-                    grid_count = int(grid_count_str)
-                    if grid_count > 0:
-                        db.session.add(SubTask(master_id=master_task.id, content=sub_content, grid_count=grid_count))
-                        subtask_added = True
-
-            if not subtask_added:
+            form_subtasks = form_subtask_fields(request.form)
+
+            if not form_subtasks:
                 flash("有効なサブタスクを少なくとも1つ入力してください。", "warning")
                 db.session.rollback() # Roll back master task creation/update if no subtasks
                 return redirect(from_url)
 
+            # Apply only the difference, keyed by the subtask ID each form row was rendered from:
+            # rows keep their ID and completion state, rows without a (known) ID are inserted,
+            # and existing subtasks no longer in the form are deleted
+            changed_subtasks = []
+            new_subtasks = []
+            for sub_content, grid_count, subtask_id in form_subtasks:
+                st = existing_subtasks.pop(subtask_id, None) # Pop so a duplicated ID can't claim the same row twice
+                if st is None:
+                    new_subtasks.append({'master_id': master_task.id, 'content': sub_content, 'grid_count': grid_count})
+                elif (st.content, st.grid_count) != (sub_content, grid_count):
+                    content_changed = st.content != sub_content
+                    changed_subtasks.append({
+                        'id': st.id, 'content': sub_content, 'grid_count': grid_count,
+                        # A rewritten subtask is a different piece of work, so it starts uncompleted
+                        'is_completed': False if content_changed else st.is_completed,
+                        'completion_date': None if content_changed else st.completion_date
+                    })
+            removed_subtask_ids = list(existing_subtasks)
+
+            if changed_subtasks:
+                db.session.execute(update(SubTask), changed_subtasks) # Bulk UPDATE by primary key
+            if new_subtasks:
+                db.session.execute(insert(SubTask), new_subtasks) # Insert new subtasks in one multi-row INSERT
+            if removed_subtask_ids:
+                db.session.execute(
+                    delete(SubTask).where(SubTask.id.in_(removed_subtask_ids)).execution_options(synchronize_session=False)
+                )
             db.session.commit()
             # Session data for temporary storage is no longer needed
             # session.pop('temp_task_data', None)
@@ -451,7 +533,7 @@ def add_or_edit_task(master_id=None):
 
         except Exception as e:
             db.session.rollback()
-            current_app.logger.error(f"Error saving task for user {current_user.id}: {e}", exc_info=True)
+            current_app.logger.error(f"Error saving task for user {user_id}: {e}", exc_info=True)
             flash(f"タスクの保存中にエラーが発生しました。", "danger") # Use generic error
             return redirect(from_url)
 
@@ -466,8 +548,11 @@ def add_or_edit_task(master_id=None):
         except ValueError:
             pass # Use today's date if param is invalid
 
-    # Fetch templates for the dropdown
-    templates = TaskTemplate.query.filter_by(user_id=current_user.id).order_by(TaskTemplate.title).all()
+    # Fetch templates for the dropdown, with their subtasks in one selectin query
+    templates = TaskTemplate.query.options(
+        load_only(TaskTemplate.id, TaskTemplate.title),
+        selectinload(TaskTemplate.subtask_templates).load_only(SubtaskTemplate.content, SubtaskTemplate.grid_count)
+    ).filter_by(user_id=user_id).order_by(TaskTemplate.title).all()
     # Prepare template data for JavaScript
     templates_data = {
         t.id: {
@@ -480,7 +565,7 @@ def add_or_edit_task(master_id=None):
     subtasks_for_template = []
     if master_task:
         # Load subtasks eagerly if not already loaded (though selectinload should handle this)
-        subtasks_for_template = [{"content": sub.content, "grid_count": sub.grid_count} for sub in master_task.subtasks]
+        subtasks_for_template = [{"id": sub.id, "content": sub.content, "grid_count": sub.grid_count} for sub in master_task.subtasks]
 
     return render_template(
         'edit_task.html',
@@ -498,10 +583,12 @@ def add_or_edit_task(master_id=None):
 @login_required
 def complete_subtask_api(subtask_id):
     """API endpoint to toggle the completion status of a subtask."""
-    subtask = db.session.get(SubTask, subtask_id)
+    user_id = current_user.id
+    # The master is needed for the permission check and the header re-render
+    subtask = db.session.get(SubTask, subtask_id, options=[joinedload(SubTask.master_task), *lazy_load_guard()])
     if not subtask:
         return jsonify({'success': False, 'error': 'Subtask not found'}), 404
-    if subtask.master_task.user_id != current_user.id:
+    if subtask.master_task.user_id != user_id:
         return jsonify({'success': False, 'error': 'Permission denied'}), 403
 
     master_task = subtask.master_task
@@ -524,41 +611,53 @@ def complete_subtask_api(subtask_id):
 
     try:
         db.session.commit()
-        current_app.logger.info(f"Subtask {subtask_id} completion toggled to {subtask.is_completed} for user {current_user.id}.")
+        current_app.logger.info(f"Subtask {subtask_id} completion toggled to {subtask.is_completed} for user {user_id}.")
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error updating subtask {subtask_id} completion: {e}", exc_info=True)
         return jsonify({'success': False, 'error': 'Database error'}), 500
 
     # --- Recalculate and return data needed for UI update ---
-    update_summary(current_user.id) # Update overall summary stats
-
-    # Re-fetch master task with its subtasks to get the latest state
-    # Use options(selectinload(...)) to ensure subtasks are loaded efficiently
-    master_task = MasterTask.query.options(selectinload(MasterTask.subtasks)).get(master_task.id)
+    # The response needs fresh values, but storing them can happen after it is sent
+    streak, average_grids = calculate_summary(user_id, today)
+    app = current_app._get_current_object()
+    def persist_summary():
+        with app.app_context(): # Own app context (and scoped session) in the worker thread
+            try:
+                save_summary(user_id, today, streak, average_grids)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Error saving summary for user {user_id}: {e}", exc_info=True)
+    summary_executor.submit(persist_summary)
 
-    # Determine visible subtasks and completion status *for the target_date*
+    # Determine visibility *for the target_date* from the master's schedule
     today_weekday = str(target_date.weekday())
     is_recurring_today = False
     if master_task.recurrence_type != 'none' and master_task.due_date <= target_date:
         if master_task.recurrence_type == 'daily': is_recurring_today = True
         elif master_task.recurrence_type == 'weekly' and master_task.recurrence_days and today_weekday in master_task.recurrence_days: is_recurring_today = True
 
+    # Re-fetch master task with only its visible subtasks (all for recurring today;
+    # uncompleted or completed on target_date otherwise), filtered in the selectin SELECT
     if is_recurring_today:
-        visible_subtasks = master_task.subtasks # Show all subtasks
+        subtasks_loader = selectinload(MasterTask.subtasks) # Show all subtasks
     else: # Normal task or recurring but not for today
-        visible_subtasks = [st for st in master_task.subtasks if not st.is_completed or st.completion_date == target_date]
-
-    visible_subtasks.sort(key=lambda x: x.id) # Ensure consistent order
+        subtasks_loader = selectinload(MasterTask.subtasks.and_(
+            or_(SubTask.is_completed == False, SubTask.completion_date == target_date)
+        ))
+    master_task = db.session.get(
+        MasterTask, master_task.id, options=[subtasks_loader, *lazy_load_guard()], populate_existing=True
+    )
+    visible_subtasks = master_task.subtasks # Already in ID order (relationship order_by)
 
     # Prepare data needed specifically for the master task header update
-    subtasks_as_dicts = [{"id": st.id, "content": st.content, "is_completed": st.is_completed, "grid_count": st.grid_count} for st in visible_subtasks]
-    master_task.visible_subtasks_json = json.dumps(subtasks_as_dicts) # For focus modal data attribute
+    master_task.visible_subtasks = visible_subtasks # Serialized for the focus modal by the subtasks_json filter
     master_task.all_completed_today = all(st.is_completed for st in visible_subtasks) if visible_subtasks else False
-    all_completed_ever = all(st.is_completed for st in master_task.subtasks)
-    if all_completed_ever:
-        completion_dates = [st.completion_date for st in master_task.subtasks if st.completion_date]
-        master_task.last_completion_date = max(completion_dates) if completion_dates else None
+    # Hidden subtasks are always completed ones, so "all visible completed" means "all completed ever"
+    if all(st.is_completed for st in visible_subtasks):
+        master_task.last_completion_date = db.session.query(func.max(SubTask.completion_date)).filter(
+            SubTask.master_id == master_task.id
+        ).scalar()
     else:
         master_task.last_completion_date = None
 
@@ -566,39 +665,16 @@ def complete_subtask_api(subtask_id):
     updated_header_html = render_template('_master_task_header.html', master_task=master_task, current_date=target_date)
 
     # --- Recalculate grid and summary data based on the *current* state ---
-    # (Similar logic to the main todo_list view, focused on the target_date)
-    all_master_tasks = MasterTask.query.options(selectinload(MasterTask.subtasks)).filter(
-        MasterTask.user_id == current_user.id, MasterTask.subtasks.any()
-    ).all()
+    # Grid totals for the target_date as one aggregate over the same visibility criteria as todo_list
+    total_grid_count, completed_grid_count = db.session.execute(
+        select(
+            func.coalesce(func.sum(SubTask.grid_count), 0),
+            func.coalesce(func.sum(case((SubTask.is_completed == True, SubTask.grid_count), else_=0)), 0)
+        ).join(MasterTask).where(MasterTask.user_id == user_id, visible_on(target_date))
+    ).one()
 
-    daily_tasks_active = []; recurring_tasks_active = []
-    for mt in all_master_tasks:
-        _is_recurring_today = False
-        if mt.recurrence_type != 'none' and mt.due_date <= target_date:
-            if mt.recurrence_type == 'daily': _is_recurring_today = True
-            elif mt.recurrence_type == 'weekly' and mt.recurrence_days and today_weekday in mt.recurrence_days: _is_recurring_today = True
-
-        if _is_recurring_today:
-            mt.visible_subtasks = mt.subtasks # Use all subtasks for recurring today
-            recurring_tasks_active.append(mt)
-        elif mt.recurrence_type == 'none' and mt.due_date == target_date:
-             mt.visible_subtasks = [st for st in mt.subtasks if not st.is_completed or st.completion_date == target_date]
-             if mt.visible_subtasks: # Only include if there are visible subtasks
-                 daily_tasks_active.append(mt)
-
-    all_subtasks_for_day_grid = []
-    for mt in daily_tasks_active: all_subtasks_for_day_grid.extend(mt.visible_subtasks)
-    for mt in recurring_tasks_active: all_subtasks_for_day_grid.extend(mt.visible_subtasks) # Use visible (all) for recurring
-
-    total_grid_count = sum(sub.grid_count for sub in all_subtasks_for_day_grid)
-    completed_grid_count = sum(sub.grid_count for sub in all_subtasks_for_day_grid if sub.is_completed)
-
-    # Fetch the latest summary data (already updated by update_summary call)
-    latest_summary = DailySummary.query.filter(DailySummary.user_id == current_user.id).order_by(DailySummary.summary_date.desc()).first()
-    summary_data = {
-        'streak': latest_summary.streak if latest_summary else 0,
-        'average_grids': latest_summary.average_grids if latest_summary else 0.0
-    }
+    # Summary values as calculated above (the stored record is updated in the background)
+    summary_data = {'streak': streak, 'average_grids': average_grids}
 
     # Return all necessary data for the frontend JS to update the UI
     return jsonify({
@@ -622,20 +698,21 @@ def habit_calendar():
 @login_required
 def habit_calendar_data(year, month):
     """API endpoint to fetch completed habit data for a given month."""
+    user_id = current_user.id
     try:
         # Validate month and year if necessary
         start_date = date(year, month, 1)
         _, last_day = calendar.monthrange(year, month) # Get the number of days in the month
         end_date = date(year, month, last_day)
 
-        current_app.logger.debug(f"Fetching habit data for User {current_user.id} {year}-{month}")
+        current_app.logger.debug(f"Fetching habit data for User {user_id} {year}-{month}")
 
         # Query distinct completion date and title for completed habits in the month
         completed_habits = db.session.query(
             SubTask.completion_date,
             MasterTask.title
         ).join(MasterTask).filter(
-            MasterTask.user_id == current_user.id,
+            MasterTask.user_id == user_id,
             MasterTask.is_habit == True,
             SubTask.is_completed == True,
             SubTask.completion_date >= start_date,
@@ -677,20 +754,35 @@ def habit_calendar_data(year, month):
 
 
 # --- Excel Import ---
+IMPORT_BATCH_SIZE = 500 # Subtasks per bulk INSERT during import
+IMPORT_MAX_BLANK_ROWS = 100 # Consecutive blank rows treated as the end of the data
+
+# Due date cell parsers by exact cell value type (datetime must not fall through to date)
+IMPORT_DATE_PARSERS = {
+    datetime: lambda value: value.date(),
+    date: lambda value: value,
+    str: lambda value: datetime.strptime(value.split(" ")[0], '%Y-%m-%d').date(), # Handle 'YYYY-MM-DD HH:MM:SS'
+    int: lambda value: from_excel(value).date(), # Excel serial date (1900 epoch, incl. the leap-year quirk)
+    float: lambda value: from_excel(value).date(),
+}
 @main_bp.route('/import', methods=['GET', 'POST'])
 @login_required
 def import_excel():
     """Handles Excel file upload and task import."""
+    user_id = current_user.id # Used inside the row loop below
     if request.method == 'POST':
         file = request.files.get('excel_file')
         if not file or not file.filename.endswith('.xlsx'):
             flash('無効なファイル形式です (.xlsxのみ)。', "warning")
             return redirect(url_for('main.import_excel'))
+        workbook = None
         try:
             current_app.logger.info(f"Starting Excel import for user {current_user.username}...")
-            workbook = openpyxl.load_workbook(file)
+            # Read-only mode streams rows from the XML instead of building every Cell in memory
+            workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
             sheet = workbook.active
-            header = [str(cell.value or '').strip() for cell in sheet[1]] # Read header row
+            header_row = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            header = [str(value or '').strip() for value in header_row] # Read header row
 
             # --- Column Mapping Logic ---
             col_map = {}
@@ -721,37 +813,44 @@ def import_excel():
                 return redirect(url_for('main.import_excel'))
 
             # --- Process Rows ---
-            master_tasks_cache = {} # Cache master tasks to avoid duplicates { (title, due_date): MasterTask }
+            parsed_subtasks = [] # (master_key, content, grid_count) per valid row, inserted after the loop
             master_task_count = 0; sub_task_count = 0; skipped_rows = 0
+            # Resolve column positions once instead of per row
+            col_title, col_due_date = col_map['title'], col_map['due_date']
+            col_sub_content, col_grid_count = col_map['sub_content'], col_map['grid_count']
+            min_row_length = max(col_map.values()) + 1
 
+            blank_run = 0 # Consecutive fully blank rows
             for row_idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
+                # Blank rows are ignored; a long run of them is formatting-only trailing space, so stop reading there
+                if not any(row):
+                    blank_run += 1
+                    if blank_run >= IMPORT_MAX_BLANK_ROWS: break
+                    continue
+                blank_run = 0
+
                 # Basic row validation
-                if len(row) <= max(col_map.values()): # Check if row has enough columns
+                if len(row) < min_row_length: # Check if row has enough columns
                     skipped_rows += 1; current_app.logger.warning(f"Skipping row {row_idx}: Not enough columns."); continue
 
                 # Extract data based on col_map
-                master_title = str(row[col_map['title']]).strip() if row[col_map['title']] else None
-                due_date_val = row[col_map['due_date']]
-                sub_content = str(row[col_map['sub_content']]).strip() if row[col_map['sub_content']] else None
-                grid_count_val = row[col_map['grid_count']]
+                # Titles repeat across rows of the same master: intern them so every row shares one string object
+                master_title = sys.intern(str(row[col_title]).strip()) if row[col_title] else None
+                due_date_val = row[col_due_date]
+                sub_content = str(row[col_sub_content]).strip() if row[col_sub_content] else None
+                grid_count_val = row[col_grid_count]
 
                 # Skip row if essential data is missing
                 if not master_title or not sub_content:
                     skipped_rows += 1; current_app.logger.warning(f"Skipping row {row_idx}: Missing master title or subtask content."); continue
 
                 # --- Parse Due Date ---
-                due_date = get_jst_today() # Default to today
-                if isinstance(due_date_val, datetime): due_date = due_date_val.date()
-                elif isinstance(due_date_val, date): due_date = due_date_val
-                elif isinstance(due_date_val, (str, int, float)):
-                    try: # Attempt to parse Excel date number or string
-                        if isinstance(due_date_val, (int, float)): # Excel date number (requires epoch adjustment)
-                            delta = timedelta(days=due_date_val - 25569) # Adjust for Excel epoch
-                            due_date = date(1970, 1, 1) + delta
-                        else: # String format
-                            str_date = str(due_date_val).split(" ")[0] # Handle 'YYYY-MM-DD HH:MM:SS'
-                            due_date = datetime.strptime(str_date, '%Y-%m-%d').date()
-                    except (ValueError, TypeError):
+                due_date = get_jst_today() # Default to today (also for empty cells)
+                parse_due_date = IMPORT_DATE_PARSERS.get(type(due_date_val))
+                if parse_due_date:
+                    try:
+                        due_date = parse_due_date(due_date_val)
+                    except (ValueError, TypeError, AttributeError, OverflowError): # AttributeError: serial < 1 is a time
                         current_app.logger.warning(f"Row {row_idx}: Could not parse date '{due_date_val}'. Using default: {due_date}.")
 
                 # --- Parse Grid Count ---
@@ -763,20 +862,43 @@ def import_excel():
                     except (ValueError, TypeError):
                         current_app.logger.warning(f"Row {row_idx}: Could not parse grid count '{grid_count_val}'. Using default: {grid_count}.")
 
-                # --- Find or Create Master Task ---
-                cache_key = (master_title, due_date)
-                if cache_key not in master_tasks_cache:
-                    master_task = MasterTask(title=master_title, due_date=due_date, user_id=current_user.id, recurrence_type='none')
-                    db.session.add(master_task); db.session.flush(); # Get ID before adding subtask
-                    master_tasks_cache[cache_key] = master_task; master_task_count += 1
-                else:
-                    master_task = master_tasks_cache[cache_key]
-
-                # --- Add Sub Task ---
-                db.session.add(SubTask(master_id=master_task.id, content=sub_content, grid_count=grid_count))
+                # --- Queue Sub Task (its master is resolved after the loop) ---
+                parsed_subtasks.append(((master_title, due_date), sub_content, grid_count))
                 sub_task_count += 1
 
-            db.session.commit() # Commit all changes at the end
+            # --- Find or Create Master Tasks ---
+            # Master IDs by (title, due_date); existing non-recurring tasks are reused so re-imports don't create copies.
+            # Only the titles in this file are looked up, and only ID/title/due_date columns are fetched.
+            master_keys = {master_key for master_key, _, _ in parsed_subtasks}
+            imported_titles = {title for title, _ in master_keys}
+            master_ids = {
+                (title, due): master_id
+                for master_id, title, due in db.session.query(MasterTask.id, MasterTask.title, MasterTask.due_date).filter(
+                    MasterTask.user_id == user_id,
+                    MasterTask.recurrence_type == 'none',
+                    MasterTask.title.in_(imported_titles)
+                )
+            } if imported_titles else {}
+            new_masters = [
+                {'title': title, 'due_date': due, 'user_id': user_id, 'recurrence_type': 'none'}
+                for title, due in master_keys if (title, due) not in master_ids
+            ]
+            if new_masters:
+                # One multi-row INSERT ... RETURNING gives every new ID without a flush per master
+                inserted = db.session.execute(
+                    insert(MasterTask).returning(MasterTask.id, MasterTask.title, MasterTask.due_date), new_masters
+                )
+                master_ids.update({(title, due): master_id for master_id, title, due in inserted})
+            master_task_count = len(new_masters)
+
+            # Insert the subtasks in batches
+            for start in range(0, len(parsed_subtasks), IMPORT_BATCH_SIZE):
+                # Plain dicts through insert(): one multi-row INSERT per batch, no ORM objects per row
+                db.session.execute(insert(SubTask), [
+                    {'master_id': master_ids[master_key], 'content': sub_content, 'grid_count': grid_count}
+                    for master_key, sub_content, grid_count in parsed_subtasks[start:start + IMPORT_BATCH_SIZE]
+                ])
+            db.session.commit() # Commit all changes at the end (the import stays all-or-nothing)
             current_app.logger.info(f"Import success: {master_task_count} masters, {sub_task_count} subs. Skipped {skipped_rows}.")
             flash(f'{master_task_count}件の親タスク ({sub_task_count}件のサブタスク) をインポート。{skipped_rows}行スキップ。', 'success')
             return redirect(url_for('main.todo_list'))
@@ -786,6 +908,9 @@ def import_excel():
             current_app.logger.error(f'Excel import failed: {e}', exc_info=True)
             flash(f'インポートエラーが発生しました。ファイル形式を確認してください。', 'danger') # Generic error
             return redirect(url_for('main.import_excel'))
+        finally:
+            if workbook is not None:
+                workbook.close() # Read-only workbooks keep the file open until closed
 
     # GET request: render the upload form
     return render_template('import.html')
@@ -796,6 +921,7 @@ def import_excel():
 @login_required
 def manage_templates():
     """Handles viewing, creating, and triggering deletion of templates."""
+    user_id = current_user.id
     back_url = request.args.get('back_url') # Preserve back URL for navigation
 
     if request.method == 'POST':
@@ -806,34 +932,23 @@ def manage_templates():
                 flash("テンプレート名は必須です。", "warning")
                 return redirect(url_for('main.manage_templates', back_url=back_url))
 
-            # Check if template exists by title for the current user
-            existing_template = TaskTemplate.query.filter_by(user_id=current_user.id, title=template_title).first()
-            if existing_template:
-                template = existing_template
-                # Delete existing subtasks before replacing them (update scenario)
-                SubtaskTemplate.query.filter_by(template_id=template.id).delete()
-                current_app.logger.info(f"Updating template '{template_title}' from manage page.")
-            else:
-                template = TaskTemplate(title=template_title, user_id=current_user.id)
-                db.session.add(template)
-                db.session.flush() # Need the ID for subtasks
-                current_app.logger.info(f"Creating template '{template_title}' from manage page.")
-
-            # Add subtasks from the form
-            subtask_count = 0
-            for i in range(1, 21): # Assume max 20 fields
-                sub_content = request.form.get(f'sub_content_{i}', '').strip()
-                grid_count_str = request.form.get(f'grid_count_{i}', '0').strip()
-                if sub_content and grid_count_str.isdigit() and int(grid_count_str) > 0:
-                    grid_count = int(grid_count_str)
-                    db.session.add(SubtaskTemplate(template_id=template.id, content=sub_content, grid_count=grid_count))
-                    subtask_count += 1
-
-            if subtask_count == 0:
+            # Collect subtasks from the form
+            new_subtask_templates = [
+                {'content': sub_content, 'grid_count': grid_count}
+                for sub_content, grid_count, _ in form_subtask_fields(request.form)
+            ]
+
+            if not new_subtask_templates:
                 flash("有効なサブタスクがないため、保存されませんでした。", "warning")
-                db.session.rollback() # Roll back template creation/update
             else:
+                # Create the template or reuse the existing one with this title, then replace its subtasks
+                template_id = upsert_task_template(user_id, template_title)
+                db.session.execute(delete(SubtaskTemplate).where(SubtaskTemplate.template_id == template_id))
+                db.session.execute(insert(SubtaskTemplate), [
+                    dict(subtask, template_id=template_id) for subtask in new_subtask_templates
+                ])
                 db.session.commit()
+                current_app.logger.info(f"Saved template '{template_title}' (ID: {template_id}) from manage page.")
                 flash(f"テンプレート「{template_title}」を保存しました。", "success")
 
         except Exception as e:
@@ -844,7 +959,11 @@ def manage_templates():
         return redirect(url_for('main.manage_templates', back_url=back_url)) # Redirect back to manage page
 
     # --- GET Request: Display templates ---
-    templates = TaskTemplate.query.filter_by(user_id=current_user.id).order_by(TaskTemplate.title).all()
+    # One selectin query for all subtask templates (instead of one lazy load per template), displayed columns only
+    templates = TaskTemplate.query.options(
+        load_only(TaskTemplate.id, TaskTemplate.title),
+        selectinload(TaskTemplate.subtask_templates).load_only(SubtaskTemplate.content, SubtaskTemplate.grid_count)
+    ).filter_by(user_id=user_id).order_by(TaskTemplate.title).all()
     return render_template('manage_templates.html', templates=templates, back_url=back_url)
 
 
@@ -887,6 +1006,7 @@ def scratchpad():
 @login_required
 def export_scratchpad():
     """API endpoint to export scratchpad items to today's quick task."""
+    user_id = current_user.id
     if not request.is_json:
         return jsonify({'success': False, 'message': '無効なリクエスト形式です。'}), 400
     tasks_to_add = request.json.get('tasks')
@@ -898,21 +1018,22 @@ def export_scratchpad():
 
     try:
         # Find or create the master task for today's quick tasks
-        master_task = MasterTask.query.filter_by(user_id=current_user.id, title=master_title, due_date=today, recurrence_type='none').first()
+        master_task = MasterTask.query.filter_by(user_id=user_id, title=master_title, due_date=today, recurrence_type='none').first()
         if not master_task:
-            master_task = MasterTask(title=master_title, due_date=today, user_id=current_user.id, recurrence_type='none')
+            master_task = MasterTask(title=master_title, due_date=today, user_id=user_id, recurrence_type='none')
             db.session.add(master_task)
             db.session.flush() # Need the ID
             current_app.logger.info(f"Created quick task master '{master_title}'.")
 
-        # Add each valid scratchpad item as a subtask
-        added_count = 0
-        for task_content in tasks_to_add:
-            if isinstance(task_content, str) and task_content.strip():
-                db.session.add(SubTask(master_id=master_task.id, content=task_content.strip(), grid_count=1)) # Default grid count 1
-                added_count += 1
+        # Add each valid scratchpad item as a subtask (default grid count 1), all in one multi-row INSERT
+        new_subtasks = [
+            {'master_id': master_task.id, 'content': task_content.strip(), 'grid_count': 1}
+            for task_content in tasks_to_add if isinstance(task_content, str) and task_content.strip()
+        ]
+        added_count = len(new_subtasks)
 
         if added_count > 0:
+            db.session.execute(insert(SubTask), new_subtasks)
             db.session.commit()
             current_app.logger.info(f"Exported {added_count} scratchpad tasks.")
             return jsonify({'success': True, 'message': f'{added_count}件のタスクを追加しました。'})
@@ -927,7 +1048,23 @@ def export_scratchpad():
 
 
 # --- Spreadsheet Export ---
+# The authorized client is shared across requests and refreshed before the OAuth token (1 hour) expires
+GSPREAD_CLIENT_TTL = 50 * 60 # seconds
+SHEET_APPEND_BATCH_SIZE = 500 # Rows per append_rows call
+_gspread_client = None
+_gspread_client_expires_at = 0.0
+_gspread_client_lock = Lock()
+
 def get_gspread_client():
+    """Returns the cached gspread client, authorizing a new one when missing or expired."""
+    global _gspread_client, _gspread_client_expires_at
+    with _gspread_client_lock: # One authorization at a time; other threads wait and reuse it
+        if _gspread_client is None or time.monotonic() >= _gspread_client_expires_at:
+            _gspread_client = _authorize_gspread_client() # None on failure, so the next call retries
+            _gspread_client_expires_at = time.monotonic() + GSPREAD_CLIENT_TTL
+        return _gspread_client
+
+def _authorize_gspread_client():
     """Helper function to authenticate and get gspread client."""
     # Prioritize environment variable, fallback to file
     sa_info = os.environ.get('GSPREAD_SERVICE_ACCOUNT')
@@ -941,7 +1078,17 @@ def get_gspread_client():
             # Assumes 'service_account.json' is in the root directory
             creds = ServiceAccountCredentials.from_json_keyfile_name('service_account.json', scope)
             current_app.logger.info("GSpread authenticated using service_account.json.")
-        return gspread.authorize(creds)
+        # AuthorizedSession needs google-auth credentials; gspread only converts oauth2client ones
+        # when it builds the session itself, so convert before passing our own session in
+        creds = convert_credentials(creds)
+        # Keep-alive pool shared by all calls of the cached client; retries only cover idempotent requests
+        # (urllib3's default methods), so a retried append can never write rows twice
+        http_session = AuthorizedSession(creds)
+        http_session.mount('https://', HTTPAdapter(
+            pool_connections=10, pool_maxsize=10,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+        ))
+        return gspread.authorize(creds, session=http_session)
     except FileNotFoundError:
         current_app.logger.error("GSpread auth failed: service_account.json not found and GSPREAD_SERVICE_ACCOUNT env var not set.")
         return None
@@ -956,19 +1103,25 @@ def get_gspread_client():
 @login_required
 def export_to_sheet():
     """Exports completed non-recurring tasks to the user's Google Sheet."""
-    if not current_user.spreadsheet_url:
+    user_id = current_user.id
+    spreadsheet_url = current_user.spreadsheet_url
+    if not spreadsheet_url:
         flash("スプレッドシートURLが設定されていません。", "warning")
         return redirect(url_for('auth.settings')) # Redirect to settings in auth blueprint
 
     # Fetch completed, non-recurring tasks with completion dates
-    completed_tasks = SubTask.query.join(MasterTask).filter(
-        MasterTask.user_id == current_user.id,
+    # Only the exported columns come back as plain rows: no ORM objects, identity map or relationship loads
+    completed_tasks_query = db.session.query(
+        MasterTask.id, MasterTask.title, SubTask.content, SubTask.grid_count, MasterTask.due_date, SubTask.completion_date
+    ).select_from(SubTask).join(SubTask.master_task).filter(
+        MasterTask.user_id == user_id,
         MasterTask.recurrence_type == 'none',
         SubTask.is_completed == True,
         SubTask.completion_date != None
-    ).order_by(SubTask.completion_date).all()
+    ).order_by(SubTask.completion_date)
 
-    if not completed_tasks:
+    # Cheap EXISTS probe; the rows themselves are streamed later
+    if not db.session.query(completed_tasks_query.exists()).scalar():
         flash("書き出す完了済みタスクがありません。", "info")
         return redirect(url_for('main.todo_list'))
 
@@ -978,69 +1131,79 @@ def export_to_sheet():
         return redirect(url_for('auth.settings')) # Redirect to settings
 
     try:
-        current_app.logger.info(f"Opening spreadsheet: {current_user.spreadsheet_url}")
-        sh = gc.open_by_url(current_user.spreadsheet_url)
+        current_app.logger.info(f"Opening spreadsheet: {spreadsheet_url}")
+        sh = gc.open_by_url(spreadsheet_url)
         worksheet = sh.sheet1 # Use the first sheet
 
-        # --- Check/Write Header ---
+        # --- Read Header and Existing Keys ---
         header = ['主タスクID', '主タスク', 'サブタスク内容', 'マス数', '期限日', '完了日', '遅れた日数']
+        current_app.logger.info("Fetching header and existing records...")
         try:
-            existing_header = worksheet.row_values(1)
+            # One batch_get for both the header row and the key columns below it (B: 主タスク ... F: 完了日),
+            # instead of a separate header probe request
+            header_range, existing_records = worksheet.batch_get(['A1:G1', 'B2:F'])
         except gspread.exceptions.APIError as api_err:
-             # Handle case where sheet might be completely empty or inaccessible briefly
+            # Handle case where sheet might be completely empty or inaccessible briefly
             if "exceeds grid limits" in str(api_err): # Heuristic for empty sheet
-                existing_header = []
+                header_range, existing_records = [], []
             else:
-                 raise # Re-raise other API errors
+                current_app.logger.error(f"GSpread API error fetching records: {api_err}")
+                flash(f"シートからのデータ取得エラー: {api_err}", "danger")
+                return redirect(url_for('main.todo_list'))
+
+        # --- Check/Write Header ---
+        existing_header = header_range[0] if header_range else []
         if not existing_header:
             worksheet.append_row(header)
             current_app.logger.info("Appended header to empty sheet.")
         elif existing_header != header:
             current_app.logger.warning("Spreadsheet header mismatch. Appending data anyway.")
 
-        # --- Fetch Existing Data to Avoid Duplicates ---
-        current_app.logger.info("Fetching existing records...")
-        try:
-            records = worksheet.get_all_values()
-            existing_records = records[1:] if len(records) > 1 else []
-            # Create a set of unique keys (Master Title, Subtask Content, Completion Date)
-            existing_keys = set( (rec[1], rec[2], rec[5]) for rec in existing_records if len(rec) >= 6) # Index 1, 2, 5
-            current_app.logger.info(f"Found {len(existing_keys)} existing unique keys.")
-        except gspread.exceptions.APIError as api_err:
-            current_app.logger.error(f"GSpread API error fetching records: {api_err}")
-            flash(f"シートからのデータ取得エラー: {api_err}", "danger")
-            return redirect(url_for('main.todo_list'))
-
-        # --- Prepare Data to Append ---
-        data_to_append = []
-        current_app.logger.info(f"Processing {len(completed_tasks)} tasks for export...")
-        for subtask in completed_tasks:
-            if not subtask.completion_date: continue # Should not happen due to query filter
-
-            completion_date_str = subtask.completion_date.strftime('%Y-%m-%d')
-            due_date_str = subtask.master_task.due_date.strftime('%Y-%m-%d')
-            # Create unique key for duplicate check
-            key = (subtask.master_task.title, subtask.content, completion_date_str)
+        # Group unique keys by completion date: { 'YYYY-MM-DD': {(Master Title, Subtask Content), ...} }
+        # Rows are not padded, so rows without a completion date are shorter than 5 cells
+        existing_keys_by_date = defaultdict(set)
+        for rec in existing_records:
+            if len(rec) >= 5: existing_keys_by_date[rec[4]].add((rec[0], rec[1])) # Columns F -> (B, C)
+        current_app.logger.info(f"Found existing records for {len(existing_keys_by_date)} completion dates.")
+
+        # --- Prepare and Append New Data ---
+        # Rows are streamed from the DB in batches and appended in bounded chunks, so neither side is held in memory;
+        # a retry after a partial failure skips the rows already written
+        data_to_append = []; appended_count = 0
+        current_app.logger.info("Processing completed tasks for export...")
+        for master_id, master_title, content, grid_count, due_date, completion_date in completed_tasks_query.yield_per(1000):
+            if not completion_date: continue # Should not happen due to query filter
+
+            completion_date_str = completion_date.strftime('%Y-%m-%d')
+            due_date_str = due_date.strftime('%Y-%m-%d')
+            # Create unique key for duplicate check (within that completion date)
+            key = (master_title, content)
+            existing_keys = existing_keys_by_date[completion_date_str]
 
             if key not in existing_keys:
-                day_diff = (subtask.completion_date - subtask.master_task.due_date).days
+                day_diff = (completion_date - due_date).days
                 data_to_append.append([
-                    subtask.master_task.id, subtask.master_task.title, subtask.content,
-                    subtask.grid_count, due_date_str,
+                    master_id, master_title, content,
+                    grid_count, due_date_str,
                     completion_date_str, day_diff
                 ])
                 existing_keys.add(key) # Add to set to prevent duplicates within this batch
+                if len(data_to_append) >= SHEET_APPEND_BATCH_SIZE:
+                    worksheet.append_rows(data_to_append, value_input_option='USER_ENTERED')
+                    appended_count += len(data_to_append); data_to_append = []
 
-        # --- Append New Data ---
-        if data_to_append:
-            current_app.logger.info(f"Appending {len(data_to_append)} new rows...")
+        if data_to_append: # Remaining partial chunk
             worksheet.append_rows(data_to_append, value_input_option='USER_ENTERED')
-            flash(f"{len(data_to_append)}件の新しい完了タスクを書き出しました。", "success")
+            appended_count += len(data_to_append)
+
+        if appended_count:
+            current_app.logger.info(f"Appended {appended_count} new rows.")
+            flash(f"{appended_count}件の新しい完了タスクを書き出しました。", "success")
         else:
             flash("スプレッドシートに書き出す新しい完了タスクはありませんでした。", "info")
 
     except gspread.exceptions.SpreadsheetNotFound:
-        current_app.logger.error(f"Spreadsheet not found: {current_user.spreadsheet_url}")
+        current_app.logger.error(f"Spreadsheet not found: {spreadsheet_url}")
         flash("指定URLのシートが見つかりません。URLと共有設定を確認してください。", "danger")
         return redirect(url_for('auth.settings'))
     except gspread.exceptions.APIError as api_err:
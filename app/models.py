@@ -1,27 +1,35 @@
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import TypeDecorator, String, Enum as SQLAlchemyEnum
-from datetime import date, datetime
-import pytz
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import Enum as SQLAlchemyEnum
+from datetime import datetime
+import os
+from zoneinfo import ZoneInfo
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
 # extensions.py から db をインポートするように変更 (循環インポート回避のため)
 from .extensions import db
 
+# argon2id によるパスワードハッシュ (C 実装、メモリハード)
+# コストは環境変数で調整可能。変更後はログイン時に password_needs_rehash で新パラメータへ再ハッシュされる
+password_hasher = PasswordHasher(
+    time_cost=int(os.environ.get('ARGON2_TIME_COST', 2)),
+    memory_cost=int(os.environ.get('ARGON2_MEMORY_COST', 65536)), # KiB
+    parallelism=int(os.environ.get('ARGON2_PARALLELISM', 2))
+)
+
+JST = ZoneInfo('Asia/Tokyo') # 標準ライブラリの zoneinfo。呼び出しごとに解決しないようモジュールで保持
+
 # --- Helper Functions ---
 def get_jst_today():
-    """JSTタイムゾーンでの今日の日付を取得"""
-    return datetime.now(pytz.timezone('Asia/Tokyo')).date()
-
-class DateAsString(TypeDecorator):
-    """SQLite で Date 型を文字列として安全に保存するためのカスタム型"""
-    impl = String
-    cache_ok = True
-    def process_bind_param(self, value, dialect):
-        # Python の date オブジェクトを ISO 形式文字列 (YYYY-MM-DD) に変換して保存
-        return value.isoformat() if value is not None else None
-    def process_result_value(self, value, dialect):
-        # DB から読み込んだ ISO 形式文字列を Python の date オブジェクトに変換
-        return date.fromisoformat(value) if value is not None else None
+    """JSTタイムゾーンでの今日の日付を取得 (リクエスト中は flask.g にキャッシュ)"""
+    if not has_request_context(): # CLI やカラムのデフォルト値などリクエスト外では毎回計算
+        return datetime.now(JST).date()
+    today = g.get('_jst_today')
+    if today is None:
+        today = g._jst_today = datetime.now(JST).date()
+    return today
 
 # --- ▼▼▼ RecurrenceType クラス定義を追加 ▼▼▼ ---
 class RecurrenceType(SQLAlchemyEnum):
@@ -47,11 +55,20 @@ class User(db.Model): # UserMixin は __init__.py で適用するためここで
 
     def set_password(self, password):
         """パスワードをハッシュ化して保存"""
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        """提供されたパスワードがハッシュと一致するか確認"""
-        return check_password_hash(self.password_hash, password)
+        """提供されたパスワードがハッシュと一致するか確認 (旧形式の pbkdf2 ハッシュにも対応)"""
+        if not self.password_hash.startswith('$argon2'):
+            return check_password_hash(self.password_hash, password)
+        try:
+            return password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def password_needs_rehash(self):
+        """旧形式のハッシュ、または現在と異なるパラメータのハッシュなら True"""
+        return not self.password_hash.startswith('$argon2') or password_hasher.check_needs_rehash(self.password_hash)
 
     # Flask-Login に必要なプロパティとメソッド (UserMixin が提供するが、明示しても良い)
     @property
@@ -67,17 +84,23 @@ class MasterTask(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     title = db.Column(db.String(100), nullable=False)
-    due_date = db.Column(DateAsString, default=get_jst_today, nullable=False) # デフォルト値は関数呼び出し
+    due_date = db.Column(db.Date, default=get_jst_today, nullable=False) # デフォルト値は関数呼び出し
     is_urgent = db.Column(db.Boolean, default=False, nullable=False)
     is_habit = db.Column(db.Boolean, default=False, nullable=False) # 習慣フラグ
     # ▼▼▼ Enum 型を使用するように修正 ▼▼▼
     recurrence_type = db.Column(db.Enum(RecurrenceType, name='recurrence_type_enum'), default=RecurrenceType.NONE, nullable=False)
     # ▲▲▲ 修正ここまで ▲▲▲
     recurrence_days = db.Column(db.String(7), nullable=True) # 繰り返し曜日 (例: '01234') 月曜=0
-    last_reset_date = db.Column(DateAsString, nullable=True) # 最後に完了状態がリセットされた日
+    last_reset_date = db.Column(db.Date, nullable=True) # 最後に完了状態がリセットされた日
 
     # リレーションシップ定義
-    subtasks = db.relationship('SubTask', backref='master_task', lazy=True, cascade="all, delete-orphan")
+    # 編集フォームや一覧で常に同じ並び (作成順) になるよう ID 順で読み込む
+    subtasks = db.relationship('SubTask', back_populates='master_task', lazy=True, cascade="all, delete-orphan", order_by='SubTask.id')
+
+    # user_id + due_date で絞り込むクエリ (todo_list のカレンダー件数など) 用の複合インデックス
+    __table_args__ = (
+        db.Index('ix_mt_user_due', 'user_id', 'due_date'),
+    )
 
 class SubTask(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -85,15 +108,29 @@ class SubTask(db.Model):
     content = db.Column(db.String(100), nullable=False)
     grid_count = db.Column(db.Integer, default=1, nullable=False)
     is_completed = db.Column(db.Boolean, default=False)
-    completion_date = db.Column(DateAsString, nullable=True)
+    completion_date = db.Column(db.Date, nullable=True)
+
+    # リレーションシップ定義
+    master_task = db.relationship('MasterTask', back_populates='subtasks')
+
+    # master_id で結合し完了状態・完了日で絞り込むクエリ (集計・クリーンアップ) 用のインデックス
+    __table_args__ = (
+        db.Index('ix_st_master_completed_date', 'master_id', 'is_completed', 'completion_date'),
+        db.Index('ix_st_completion_date', 'completion_date'),
+    )
 
 class DailySummary(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    summary_date = db.Column(DateAsString, nullable=False)
+    summary_date = db.Column(db.Date, nullable=False)
     streak = db.Column(db.Integer, default=0)
     average_grids = db.Column(db.Float, default=0.0)
 
+    # ユーザーごとに1日1件 (INSERT ... ON CONFLICT による保存の対象)
+    __table_args__ = (
+        db.Index('uq_dailysummary_user_date', 'user_id', 'summary_date', unique=True),
+    )
+
 class TaskTemplate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -102,6 +139,11 @@ class TaskTemplate(db.Model):
     # リレーションシップ定義
     subtask_templates = db.relationship('SubtaskTemplate', backref='task_template', lazy=True, cascade="all, delete-orphan")
 
+    # テンプレート名はユーザーごとに一意 (INSERT ... ON CONFLICT による保存の対象)
+    __table_args__ = (
+        db.Index('uq_tasktemplate_user_title', 'user_id', 'title', unique=True),
+    )
+
 class SubtaskTemplate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     template_id = db.Column(db.Integer, db.ForeignKey('task_template.id'), nullable=False)
@@ -3,14 +3,26 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def engine_options(db_url):
+    """SQLAlchemy engine options; pool sizing only applies to server databases such as Postgres."""
+    options = {
+        # Set DB_POOL_PRE_PING=0 when TCP keepalive already detects dead connections (saves a SELECT 1 per checkout)
+        "pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+        "pool_recycle": 300,
+    }
+    if db_url and 'sqlite' not in db_url:
+        # Keep (gunicorn workers x (pool_size + max_overflow)) below Postgres max_connections
+        options["pool_size"] = int(os.environ.get('DB_POOL_SIZE', 10))
+        options["max_overflow"] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+        # Fail fast instead of stalling 30s (the default) when the pool is exhausted during bursts
+        options["pool_timeout"] = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    return options
+
 class Config:
     """Base configuration."""
     SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "a-very-secret-key-for-local-development")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        "pool_pre_ping": True,
-        "pool_recycle": 300,
-    }
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(None)
 
 class DevelopmentConfig(Config):
     """Development configuration."""
@@ -27,6 +39,7 @@ class DevelopmentConfig(Config):
         db_url = f'sqlite:///{os.path.join(instance_path, "tasks.db")}'
 
     SQLALCHEMY_DATABASE_URI = db_url
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(db_url)
 
 class ProductionConfig(Config):
     """Production configuration."""
@@ -35,6 +48,7 @@ class ProductionConfig(Config):
     if db_url and db_url.startswith("postgres://"):
         db_url = db_url.replace("postgres://", "postgresql://", 1)
     SQLALCHEMY_DATABASE_URI = db_url
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(db_url)
     # Add any other production-specific settings here
     # For example, session cookie settings for security
     # SESSION_COOKIE_SECURE = True